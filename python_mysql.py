@@ -16,13 +16,19 @@
 
 """A lightweight wrapper around MySQLdb."""
 
-import copy
+import contextlib
 import MySQLdb
 import MySQLdb.constants
+import MySQLdb.constants.CLIENT
 import MySQLdb.converters
 import MySQLdb.cursors
 import itertools
 import logging
+import operator
+import os
+import Queue
+import re
+import threading
 from time import time
 
 class Connection(object):
@@ -38,10 +44,37 @@ class Connection(object):
     Cursors are hidden by the implementation, but other than that, the methods
     are very similar to the DB-API.
 
+    The underlying MySQLdb connections are shared through a per-server pool,
+    so creating and closing Connection objects does not pay for a new TCP
+    handshake and login each time. pool_size bounds the number of idle
+    connections kept around; a connection idle for longer than
+    max_idle_time seconds is pinged before it is used again. Connections
+    with different pool_size or max_idle_time values use separate pools.
+    A forked child never reuses connections inherited from its parent, and
+    close_idle_connections() really closes the idle pooled connections.
+
+    With query_cache_ttl set to a number of seconds, results of SELECTs run
+    through query()/get() are cached per Connection for that long. Writes
+    made through this Connection evict cached results that mention the
+    written table; call invalidate() after changes made elsewhere. Cached
+    rows are shared between callers, so treat them as read-only. Locking
+    reads (FOR UPDATE, LOCK IN SHARE MODE) and SELECTs that use variables,
+    connection state or time/random functions such as LAST_INSERT_ID() or
+    NOW() always go to the server.
+    count_cache_ttl does the same for the values returned by count(),
+    typically with a shorter lifetime.
+
+    With multi_statements=True the server accepts several statements in one
+    request, which lets batch() send buffered writes together.
+
     We explicitly set the timezone to UTC and the character encoding to
     UTF-8 on all connections to avoid time zone and encoding errors.
     """
-    def __init__(self, host, database, user=None, password=None):
+    iter_batch_size = 10000
+
+    def __init__(self, host, database, user=None, password=None,
+                 pool_size=10, max_idle_time=60, query_cache_ttl=0,
+                 count_cache_ttl=0, multi_statements=False):
         self.host = host
         self.database = database
 
@@ -52,6 +85,8 @@ class Connection(object):
             args["user"] = user
         if password is not None:
             args["passwd"] = password
+        if multi_statements:
+            args["client_flag"] = MySQLdb.constants.CLIENT.MULTI_STATEMENTS
 
         # We accept a path to a MySQL socket file or a host(:port) string
         if "/" in host:
@@ -66,8 +101,20 @@ class Connection(object):
                 args["host"] = host
                 args["port"] = 3306
 
+        self.max_idle_time = max_idle_time
+        self.multi_statements = multi_statements
+        self._batch = None
         self._db = None
         self._db_args = args
+        self._db_pid = None
+        self._last_use_time = time()
+        self._pool = _get_pool(args, pool_size, max_idle_time)
+        self._query_cache = None
+        if query_cache_ttl:
+            self._query_cache = _ResultCache(query_cache_ttl)
+        self._count_cache = None
+        if count_cache_ttl:
+            self._count_cache = _ResultCache(count_cache_ttl)
         try:
             self.reconnect()
         except:
@@ -78,17 +125,19 @@ class Connection(object):
         self.close()
 
     def close(self):
-        """Closes this database connection."""
+        """Returns this database connection to the pool."""
         if self._db is not None:
-            self._db.close()
+            if self._db_pid == os.getpid():
+                self._pool.put(self._db)
+            else:
+                _abandon(self._db)
             self._db = None
 
     def commit(self):
+        if self._batch is not None:
+            raise OperationalError, \
+                "commit() would run before the buffered batch() statements"
         if self._db is not None:
-            try:
-                self._db.ping()
-            except:
-                self.reconnect()
             try:
                 self._db.commit()
             except Exception,e:
@@ -96,6 +145,11 @@ class Connection(object):
                 logging.exception("Can not commit",e)
 
     def rollback(self):
+        if self._batch is not None:
+            raise OperationalError, \
+                "rollback() would run before the buffered batch() statements"
+        # Results read inside the rolled back transaction may be cached
+        self.invalidate()
         if self._db is not None:
             try:
                 self._db.rollback()
@@ -103,33 +157,66 @@ class Connection(object):
                 logging.error("Can not rollback")
 
     def reconnect(self):
-        """Closes the existing database connection and re-opens it."""
-        self.close()
-        self._db = MySQLdb.connect(**self._db_args)
-        self._db.autocommit(False)
-
+        """Drops the existing database connection and takes a new one."""
+        self._discard()
+        self._db = self._pool.get()
+        self._db_pid = os.getpid()
+        self._last_use_time = time()
+
+    def _discard(self):
+        """Closes the current connection without returning it to the pool."""
+        if self._db is not None:
+            if self._db_pid != os.getpid():
+                _abandon(self._db)
+            else:
+                try:
+                    self._db.close()
+                except:
+                    pass
+            self._db = None
 
     def iter(self, query, *parameters):
         """Returns an iterator for the given query and parameters."""
-        if self._db is None: self.reconnect()
-        cursor = MySQLdb.cursors.SSCursor(self._db)
-        try:
+        for column_names, rows in self._iter_batches(query, parameters):
+            for row in rows:
+                yield Row(itertools.izip(column_names, row))
+
+    def iter_raw(self, query, *parameters):
+        """Like iter(), but yields the plain row tuples."""
+        for column_names, rows in self._iter_batches(query, parameters):
+            for row in rows:
+                yield row
+
+    def _iter_batches(self, query, parameters):
+        # Streams the result with an unbuffered cursor, fetching
+        # iter_batch_size rows per call rather than one row at a time.
+        with self._scoped_cursor(MySQLdb.cursors.SSCursor) as cursor:
             self._execute(cursor, query, parameters)
-            column_names = [d[0] for d in cursor.description]
-            for row in cursor:
-                yield Row(zip(column_names, row))
-        finally:
-            cursor.close()
+            column_names = tuple(map(_column_name, cursor.description))
+            while True:
+                rows = cursor.fetchmany(self.iter_batch_size)
+                if not rows:
+                    break
+                yield column_names, rows
 
     def query(self, query, *parameters):
         """Returns a row list for the given query and parameters."""
-        cursor = self._cursor()
-        try:
+        cache_key = self._cache_key(self._query_cache, query, parameters)
+        if cache_key is not None:
+            rows = self._query_cache.get(cache_key)
+            if rows is not None:
+                return list(rows)
+        with self._scoped_cursor() as cursor:
             self._execute(cursor, query, parameters)
-            column_names = [d[0] for d in cursor.description]
-            return [Row(itertools.izip(column_names, row)) for row in cursor]
-        finally:
-            cursor.close()
+            column_names = tuple(map(_column_name, cursor.description))
+            # fetchall() hands back the buffered rows in one call, where
+            # iterating the cursor goes through fetchone() for every row
+            rows = [Row(itertools.izip(column_names, row))
+                    for row in cursor.fetchall()]
+        if cache_key is not None:
+            self._query_cache.set(cache_key, rows)
+            return list(rows)
+        return rows
 
 
 
@@ -144,21 +231,96 @@ class Connection(object):
             return rows[0]
 
     def execute(self, query, *parameters):
-        """Executes the given query, returning the lastrowid from the query."""
-        cursor = self._cursor()
-        try:
+        """Executes the given query, returning the lastrowid from the query.
+
+        Inside a batch() block the query is only buffered and None is
+        returned.
+        """
+        if self._batch is not None:
+            self._invalidate_written(query)
+            self._ensure_connected()
+            self._batch.append(self._mogrify(query, parameters))
+            return None
+        with self._scoped_cursor() as cursor:
             self._execute(cursor, query, parameters)
             return cursor.lastrowid
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Buffers execute()/executemany() calls and sends them on exit.
+
+        The buffered statements are joined with ";" into as few requests as
+        _MAX_STATEMENT_LENGTH allows, instead of one round-trip each, and
+        keep the order they were issued in. This covers Insert (single and
+        bulk), Update and Delete too, as they go through execute() and
+        executemany(). Nothing is sent if the block raises. commit() and
+        rollback() can not be called inside the block; call them after it.
+        Typical usage:
+
+            db = database.Connection("localhost", "mydatabase",
+                                     multi_statements=True)
+            with db.batch():
+                for id in ids:
+                    db.execute("UPDATE articles SET hits=hits+1 WHERE id=%s",
+                               id)
+            db.commit()
+        """
+        if not self.multi_statements:
+            raise OperationalError, \
+                "batch() needs a Connection with multi_statements=True"
+        if self._batch is not None:
+            raise OperationalError, "batch() can not be nested"
+        self._batch = []
+        try:
+            yield
+            statements = self._batch
         finally:
-            cursor.close()
+            self._batch = None
+        self._execute_batch(statements)
+
+    def _execute_batch(self, statements):
+        with self._scoped_cursor() as cursor:
+            chunk = []
+            length = 0
+            for statement in statements:
+                if chunk and \
+                        length + len(statement) + 1 > _MAX_STATEMENT_LENGTH:
+                    self._execute_multi(cursor, ";".join(chunk))
+                    chunk = []
+                    length = 0
+                chunk.append(statement)
+                length += len(statement) + 1
+            if chunk:
+                self._execute_multi(cursor, ";".join(chunk))
+        # The joined request only names its first statement's table
+        for statement in statements:
+            self._invalidate_written(statement)
+
+    def _execute_multi(self, cursor, query):
+        self._execute(cursor, query, None)
+        # Errors from later statements surface while stepping the results
+        while cursor.nextset():
+            pass
+
+    def _mogrify(self, query, parameters):
+        # Interpolates the parameters the same way MySQLdb's cursor does
+        if isinstance(query, unicode):
+            query = query.encode(self._db.character_set_name())
+        return query % self._db.literal(parameters)
+
     def count(self,query, *parameters):
         """Executes the given query, returning the count value from the query."""
-        cursor = self._cursor()
-        try:
-            cursor.execute(query, parameters)
-            return cursor.fetchone()[0]
-        finally:
-            cursor.close()
+        cache_key = self._cache_key(self._count_cache, query, parameters)
+        if cache_key is not None:
+            value = self._count_cache.get(cache_key)
+            if value is not None:
+                return value
+        with self._scoped_cursor() as cursor:
+            self._execute(cursor, query, parameters)
+            value = cursor.fetchone()[0]
+        if cache_key is not None:
+            self._count_cache.set(cache_key, value)
+        return value
 
     def __getattr__(self,tablename):
         '''
@@ -172,40 +334,266 @@ class Connection(object):
         '''
         return TableQueryer(self,Select)
 
-    def insert(self,table,**datas):
+    def insert(self,table,*rows,**datas):
         '''
         Executes the given parameters to an insert SQL and execute it
         '''
-        return Insert(self,table)(**datas)
+        return Insert(self,table)(*rows,**datas)
 
-    def executemany(self, query, parameters):
+    def executemany(self, query, parameters, chunk_size=1000):
         """Executes the given query against all the given param sequences.
 
-        We return the lastrowid from the query.
+        INSERT/REPLACE ... VALUES statements are sent as multi-row inserts
+        of at most chunk_size rows and _MAX_STATEMENT_LENGTH bytes each, so
+        that a huge batch does not overflow the server's max_allowed_packet.
+        Other statements are handed to the driver chunk_size at a time.
+
+        We return the lastrowid from the query, or None inside a batch()
+        block, where the statements are only buffered.
         """
-        cursor = self._cursor()
-        try:
-            cursor.executemany(query, parameters)
+        self._invalidate_written(query)
+        match = _INSERT_VALUES_RE.match(query)
+        if match is not None and "%" in match.group(1) + match.group(3):
+            match = None
+        if self._batch is not None:
+            self._ensure_connected()
+            if match is not None:
+                self._batch.extend(self._render_insert_many(match, parameters,
+                                                            chunk_size))
+            else:
+                self._batch.extend(self._mogrify(query, params)
+                                   for params in parameters)
+            return None
+        with self._scoped_cursor() as cursor:
+            parameters = iter(parameters)
+            if match is not None:
+                for statement in self._render_insert_many(match, parameters,
+                                                          chunk_size):
+                    self._execute(cursor, statement, None)
+                return cursor.lastrowid
+            while True:
+                chunk = list(itertools.islice(parameters, chunk_size))
+                if not chunk:
+                    break
+                cursor.executemany(query, chunk)
             return cursor.lastrowid
+
+    def _render_insert_many(self, match, parameters, chunk_size):
+        # Renders one "(...)" group per param sequence and joins them into
+        # as few INSERT statements as the size limits allow.
+        prefix, values, suffix = match.groups()
+        if isinstance(values, unicode):
+            charset = self._db.character_set_name()
+            prefix, values, suffix = [part.encode(charset) for part in
+                                      (prefix, values, suffix)]
+        literal = self._db.literal
+        rows = []
+        length = len(prefix) + len(suffix)
+        for params in parameters:
+            row = values % literal(params)
+            if rows and (len(rows) >= chunk_size or
+                         length + len(row) + 1 > _MAX_STATEMENT_LENGTH):
+                yield prefix + ",".join(rows) + suffix
+                rows = []
+                length = len(prefix) + len(suffix)
+            rows.append(row)
+            length += len(row) + 1
+        if rows:
+            yield prefix + ",".join(rows) + suffix
+
+    def _ensure_connected(self):
+        # Only ping a connection that has sat idle for a while, instead of
+        # paying an extra round-trip before every query.
+        if self._db is None or self._db_pid != os.getpid():
+            self.reconnect()
+        elif time() - self._last_use_time > self.max_idle_time:
+            try:
+                self._db.ping()
+            except:
+                self.reconnect()
+        self._last_use_time = time()
+
+    def _cursor(self, cursorclass=None):
+        self._ensure_connected()
+        return self._db.cursor(cursorclass)
+
+    @contextlib.contextmanager
+    def _scoped_cursor(self, cursorclass=None):
+        """Yields a cursor on a live connection and closes it afterwards."""
+        cursor = self._cursor(cursorclass)
+        try:
+            yield cursor
         finally:
             cursor.close()
 
-    def _cursor(self):
-        if self._db is None: self.reconnect()
+    def invalidate(self, table=None):
+        """Drops cached query results that mention table, or all of them."""
+        for cache in (self._query_cache, self._count_cache):
+            if cache is not None:
+                cache.invalidate(table)
+
+    def _cache_key(self, cache, query, parameters):
+        # Only SELECTs with hashable parameters go through the cache, and
+        # not inside batch(), where buffered writes have not hit the server
+        if cache is None or self._batch is not None or \
+                not _SELECT_RE.match(query) or _UNCACHEABLE_RE.search(query):
+            return None
+        key = (query, parameters)
         try:
-            self._db.ping()
-        except:
-            self.reconnect()
-        return self._db.cursor()
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _invalidate_written(self, query):
+        if self._query_cache is None and self._count_cache is None:
+            return
+        if not _SELECT_RE.match(query):
+            # Only single-table writes name their table reliably; anything
+            # else (multi-table UPDATE/DELETE, DDL, ...) clears everything
+            match = _WRITE_RE.match(query)
+            self.invalidate(match.group(match.lastindex) if match else None)
 
     def _execute(self, cursor, query, parameters):
+        self._invalidate_written(query)
         try:
             return cursor.execute(query, parameters)
         except OperationalError:
             logging.error("Error connecting to MySQL on %s", self.host)
-            self.close()
+            self._discard()
             raise
 
+class _ConnectionPool(object):
+    """A bounded pool of idle MySQLdb connections sharing the same args."""
+    def __init__(self, db_args, maxsize, max_idle_time):
+        self._db_args = db_args
+        self._max_idle_time = max_idle_time
+        self._maxsize = maxsize
+        self._idle = Queue.Queue(maxsize)
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        # The idle connections of a forked child still talk to the parent's
+        # sessions, so start over with an empty pool in the child
+        if self._pid != os.getpid():
+            idle, self._idle = self._idle, Queue.Queue(self._maxsize)
+            self._pid = os.getpid()
+            while True:
+                try:
+                    _abandon(idle.get_nowait()[0])
+                except Queue.Empty:
+                    break
+
+    def get(self):
+        """Returns an idle connection, or a new one if none is available."""
+        self._check_pid()
+        while True:
+            try:
+                db, last_use_time = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            if time() - last_use_time <= self._max_idle_time:
+                return db
+            try:
+                db.ping()
+                return db
+            except:
+                try:
+                    db.close()
+                except:
+                    pass
+        db = MySQLdb.connect(**self._db_args)
+        db.autocommit(False)
+        return db
+
+    def put(self, db):
+        """Takes back a connection, closing it if the pool is full."""
+        self._check_pid()
+        try:
+            # Never hand out a connection with a pending transaction
+            db.rollback()
+            self._idle.put_nowait((db, time()))
+        except:
+            try:
+                db.close()
+            except:
+                pass
+
+    def close_idle(self):
+        """Closes every idle connection held by this pool."""
+        self._check_pid()
+        while True:
+            try:
+                db = self._idle.get_nowait()[0]
+            except Queue.Empty:
+                break
+            try:
+                db.close()
+            except:
+                pass
+
+class _ResultCache(object):
+    """A bounded in-process cache of query results with a time-to-live."""
+    def __init__(self, ttl, maxsize=1024):
+        self._ttl = ttl
+        self._maxsize = maxsize
+        self._entries = {}
+
+    def get(self, key):
+        """Returns the cached value for key, or None if missing or stale."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time():
+            del self._entries[key]
+            return None
+        return value
+
+    def set(self, key, value):
+        if len(self._entries) >= self._maxsize:
+            self._entries.clear()
+        self._entries[key] = (time() + self._ttl, value)
+
+    def invalidate(self, table=None):
+        """Drops entries whose query mentions table, or all entries."""
+        if table is None:
+            self._entries.clear()
+            return
+        table = table.lower()
+        for key in self._entries.keys():
+            if table in key[0].lower():
+                del self._entries[key]
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+# Connections inherited across fork(). Closing them, even implicitly when
+# they are garbage collected, would end the parent's sessions, so they are
+# kept referenced and never used again.
+_ABANDONED = []
+
+def _abandon(db):
+    _ABANDONED.append(db)
+
+def close_idle_connections():
+    """Closes the idle connections of every pool, e.g. before shutting down."""
+    with _POOLS_LOCK:
+        pools = _POOLS.values()
+    for pool in pools:
+        pool.close_idle()
+
+def _get_pool(db_args, maxsize, max_idle_time):
+    """Returns the pool shared by all connections with the same settings."""
+    key = (tuple(sorted((k, v) for k, v in db_args.iteritems()
+                        if k != "conv")), maxsize, max_idle_time)
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            pool = _POOLS[key] = _ConnectionPool(db_args, maxsize,
+                                                 max_idle_time)
+        return pool
+
 class TableQueryer:
     '''
     Support for single table simple querys
@@ -222,8 +610,8 @@ class TableQueryer:
             return rs[0]
         return None
 
-    def insert(self,**fields):
-        return Insert(self.db,self.tablename)(**fields)
+    def insert(self,*rows,**fields):
+        return Insert(self.db,self.tablename)(*rows,**fields)
 
     def __call__(self,query=None):
         return Operater(self.db,self.tablename,query)
@@ -250,11 +638,11 @@ class Count (object):
 
     def __call__(self):
         if self.where:
-            _sql="".join(["SELECT count(1) FROM ",self.tablename," where ",self.where.get_sql()])
+            _sql="SELECT count(1) FROM %s where %s"%(self.tablename,self.where.get_sql())
             _params=self.where.get_params()
             return self.db.count(_sql,*_params)
         else:
-            _sql="",join(["SELECT count(1) FROM ",self.tablename])
+            _sql="SELECT count(1) FROM %s"%self.tablename
             return self.db.count(_sql)
 
 class Select:
@@ -274,11 +662,11 @@ class Select:
     def sort(self,**fields):
         del self._sort_fields[:]
         for key in fields.keys():
-            self._sort_fields.append("".join(["`",key,"` ",fields[key]]))
+            self._sort_fields.append("`%s` %s"%(key,fields[key]))
         return self
 
     def limit(self,start,count):
-        self._limit="".join(["LIMIT ",str(start),",",str(count)])
+        self._limit="LIMIT %s,%s"%(start,count)
         return self
 
     def collect(self,*fields):
@@ -301,33 +689,40 @@ class Select:
         if pcount<1:
             raise OperationalError,"Wrong page size,page size can not lower than 1"
         _start=(pid-1)*pcount
-        self._limit="".join(["LIMIT ",str(_start),",",str(pcount)])
+        self._limit="LIMIT %s,%s"%(_start,pcount)
         return self
 
     def get_sql(self):
+        '''
+        Returns the SELECT statement. A subquery is aliased as t and the
+        outer columns are qualified with that alias:
+
+        >>> t=TableQueryer(None,"user")
+        >>> q=Select(None,Select(None,"user",t.age>3),t.age<9)
+        >>> q.sort(age="DESC").get_sql()
+        'SELECT * FROM (SELECT * FROM `user` WHERE `age`>%s  )t WHERE t.`age`<%s  ORDER BY t.`age` DESC'
+        '''
         _sql_slice=["SELECT "]
         if self._fields:
-            _sql_slice.append(",".join(["".join(["`",str(f),"`"]) for f in self._fields]))
+            _sql_slice.append(",".join(["`%s`"%f for f in self._fields]))
         else:
             _sql_slice.append("*")
-        _sql_slice.append(" FROM `")
-        if str(self._tablename.__class__)=="database.Select":
-            _sql_slice.append("(")
-            _sql_slice.append(self._tablename.get_sql())
-            _sql_slice.append(")t")
+        _sql_slice.append(" FROM ")
+        _subquery=isinstance(self._tablename,Select)
+        if _subquery:
+            _sql_slice.append("(%s)t"%self._tablename.get_sql())
         else:
-            _sql_slice.append(self._tablename)
-        _sql_slice.append("`")
+            _sql_slice.append("`%s`"%self._tablename)
         if self._where:
             _sql_slice.append(" WHERE ")
-            if str(self._tablename.__class__)=="database.Select":
+            if _subquery:
                 _sql_slice.append(self._where.get_sql(tn='t'))
             else:
                  _sql_slice.append(self._where.get_sql())
             _sql_slice.append(" ")
         if len(self._groups)>0:
             _sql_slice.append("GROUP BY ")
-            if str(self._tablename.__class__)=="database.Select":
+            if _subquery:
                 _sql_slice.append(",".join([f.get_sql(tn="t") for f in self._groups]))
             else:
                 _sql_slice.append(",".join([f.get_sql() for f in self._groups]))
@@ -337,32 +732,31 @@ class Select:
                 _sql_slice.append(" ")
         if self._sort_fields:
             _sql_slice.append("ORDER BY ")
-            if str(self._tablename.__class__)=="database.Select":
+            if _subquery:
                 _sql_slice.append(",".join([self._add_tb('t',s) for s in self._sort_fields]))
             else:
-                _sql_slice.append(",".join([s for s in self._sort_fields]))
+                _sql_slice.append(",".join(self._sort_fields))
         if self._limit:
             _sql_slice.append(" ")
             _sql_slice.append(self._limit)
         return "".join(_sql_slice)
     
     def _add_tb(self,tn,src):
-        import re
-        p=compile(r'`(\w*?)`')
-        return p.sub(r'`%s.\1`'%tn,src)
+        return _BACKTICK_RE.sub(r'%s.`\1`'%tn,src)
 
-    def __call__(self):
-        _sql=self.get_sql()
+    def get_params(self):
         _plist=[]
-        if str(self._tablename.__class__)=="database.Select":
-            for p in self._tablename.get_sql():
-                _plist.append(p)
+        if isinstance(self._tablename,Select):
+            _plist+=self._tablename.get_params()
         if self._where:
-            for p in self._where:
-                _plist.append(p)
+            _plist+=self._where.get_params()
         if self._having:
-            for p in self._having.get_params():
-                _plist.append(p)
+            _plist+=self._having.get_params()
+        return _plist
+
+    def __call__(self):
+        _sql=self.get_sql()
+        _plist=self.get_params()
         if _plist:
             return self.db.query(_sql,*_plist)
         else:
@@ -381,12 +775,12 @@ class Update:
     def __call__(self,*fields):
         if len(fields)<1:
             raise OperationalError,"Must have unless 1 field to update"
-        _params=[]
         _cols=[]
+        _params=[]
         for f in fields:
             _cols.append(f.get_sql())
-            _params.append(f.get_params()[0])
-        _sql_slice=["UPDATE ",self._tablename," SET ",",".join(_cols)]
+            _params.extend(f.get_params())
+        _sql_slice=["UPDATE %s SET %s"%(self._tablename,",".join(_cols))]
         if self._where:
             _sql_slice.append(" WHERE ")
             _sql_slice.append(self._where.get_sql())
@@ -402,13 +796,40 @@ class Delete:
         self._where=where
 
     def __call__(self):
-        _sql_slice=["DELETE FROM `",self._tablename,"`"]
+        _sql_slice=["DELETE FROM `%s`"%self._tablename]
         if self._where:
             _sql_slice.append(" WHERE ")
             _sql_slice.append(self._where.get_sql())
             _sql="".join(_sql_slice)
             return self.db.execute(_sql,self._where.get_params())
 
+_INSERT_SQL_CACHE = {}
+_INSERT_SQL_CACHE_SIZE = 1024
+
+# "%s,%s,..." placeholder lists, indexed by the number of columns
+_PLACEHOLDERS = [("%s,"*n)[:-1] for n in range(65)]
+
+def _placeholders(count):
+    if count<len(_PLACEHOLDERS):
+        return _PLACEHOLDERS[count]
+    return ("%s,"*count)[:-1]
+
+def _insert_sql(tablename,columns):
+    '''
+    Returns the INSERT template for a table and a tuple of column names,
+    building it only the first time that set of columns is seen
+    '''
+    key=(tablename,columns)
+    _sql=_INSERT_SQL_CACHE.get(key)
+    if _sql is None:
+        _fields=",".join(["`%s`"%column for column in columns])
+        _sql="INSERT INTO `%s`(%s) VALUES (%s)"%(tablename,_fields,
+                                                 _placeholders(len(columns)))
+        if len(_INSERT_SQL_CACHE)>=_INSERT_SQL_CACHE_SIZE:
+            _INSERT_SQL_CACHE.clear()
+        _INSERT_SQL_CACHE[key]=_sql
+    return _sql
+
 class Insert:
     '''
     Insert Query Generator
@@ -417,14 +838,32 @@ class Insert:
         self.db=db
         self.tablename=tablename
 
-    def __call__(self,**fileds):
-        columns=fileds.keys()
-        _prefix="".join(['INSERT INTO `',self.tablename,'`'])
-        _fields=",".join(["".join(['`',column,'`']) for column in columns])
-        _values=",".join(["%s" for i in range(len(columns))])
-        _sql="".join([_prefix,"(",_fields,") VALUES (",_values,")"])
-        _params=[fileds[key] for key in columns]
-        return self.db.execute(_sql,*tuple(_params))
+    def __call__(self,*rows,**fileds):
+        '''
+        Insert one row given as keyword arguments, or many rows given as
+        dicts (or a single list of dicts) sharing the same columns; an
+        empty list inserts nothing
+        '''
+        if rows:
+            if fileds:
+                raise OperationalError,"Can not mix row dicts with keyword fields"
+            if len(rows)==1 and isinstance(rows[0],(list,tuple)):
+                rows=rows[0]
+                if not rows:
+                    return None
+            columns=tuple(rows[0])
+            _keys=set(columns)
+            for row in rows:
+                if len(row)!=len(_keys) or _keys.difference(row):
+                    raise OperationalError,"All rows must have the same fields"
+            _sql=_insert_sql(self.tablename,columns)
+            # executemany() folds these into multi-row INSERT statements
+            _params=[[row[key] for key in columns] for row in rows]
+            return self.db.executemany(_sql,_params)
+        # keys() and values() of an unchanged dict come in the same order
+        columns=tuple(fileds)
+        _sql=_insert_sql(self.tablename,columns)
+        return self.db.execute(_sql,*fileds.values())
 
 class Row(dict):
     """A dict that allows for object-like property access syntax."""
@@ -435,13 +874,19 @@ class Row(dict):
             raise AttributeError(name)
 
 
-class conds:
+class conds(object):
+    # One of these is built for every table.field access, so keep
+    # instances free of a per-instance __dict__
+    __slots__=('field_name','_sql','_params','_has_value','_sub_conds',
+               '_no_value')
+
     def __init__(self,field):
         self.field_name=field
         self._sql=""
         self._params=[]
         self._has_value=False
-        self._sub_conds=[]
+        # Only chained conditions need a list, so create it on demand
+        self._sub_conds=None
         self._no_value=False
 
     def _prepare(self,sql,value):
@@ -458,128 +903,183 @@ class conds:
         else:
             return self.field_name
 
+    def _walk(self):
+        # Yields (cond, joiner) for this condition and every nested one in
+        # the order they appear in the SQL, without recursing
+        _stack=[(self,"")]
+        while _stack:
+            cond,op=_stack.pop()
+            yield cond,op
+            if cond._sub_conds:
+                _stack.extend(reversed(cond._sub_conds))
+
     def get_sql(self,tn=None):
         _sql_slice=[]
-        _sql_slice.append(self._sql)
-        _sql_slice.append(" ")
-        if len(self._sub_conds):
-            for cond in self._sub_conds:
-                _sql_slice.append(cond[1])
-                _sql_slice.append(cond[0].get_sql()) 
+        for cond,op in self._walk():
+            _sql_slice.append(op)
+            _sql_slice.append(cond._sql)
+            _sql_slice.append(" ")
         _where = "".join(_sql_slice)
         if tn:
-            import re
-            p=compile(r'`(\w*?)`')
-            _where = p.sub(r'`%s.\1`'%tn,_where)
+            _where = _BACKTICK_RE.sub(r'%s.`\1`'%tn,_where)
         return _where
 
     def get_params(self):
-        _my_params=[]+self._params
-        if len(self._sub_conds):
-            for cond in self._sub_conds:
-                _my_params+=cond[0].get_params()
+        _my_params=[]
+        for cond,op in self._walk():
+            _my_params.extend(cond._params)
         return _my_params
 
     def __sub__(self,value):
-        return self._prepare("".join(["`",self.field_name,"`-%s"]),value)
+        return self._prepare("`%s`-%%s"%self.field_name,value)
 
     def __add__(self,value):
-        return self._prepare("".join(["`",self.field_name,"`+%s"]),value)
+        return self._prepare("`%s`+%%s"%self.field_name,value)
 
     def __ne__(self,value):
-        return self._prepare("".join(["`",self.field_name,'`','<>%s']),value)
+        return self._prepare("`%s`<>%%s"%self.field_name,value)
 
     def __eq__(self,value):
         if not self._has_value:
-            if str(value.__class__)=="database.conds":
-                self._sql="".join(["`",self.field_name,'`','=',value.get_sql()])
-                self._params.append(value.get_params()[0])
+            if isinstance(value,conds) and value._has_value:
+                # t.a==t.b+1
+                self._sql="`%s`=%s"%(self.field_name,value.get_sql())
+                self._params.extend(value.get_params())
+            elif isinstance(value,conds):
+                # t.a==t.b compares two columns and takes no params
+                self._sql="`%s`=`%s`"%(self.field_name,value.field_name)
             else:
-                self._sql="".join(["`",self.field_name,'`','=%s'])
+                self._sql="`%s`=%%s"%self.field_name
                 self._params.append(value)
             self._has_value=True
             return self
         raise OperationalError,"Multiple Operate conditions"
 
     def like(self,value):
-        return self._prepare("".join(["`",self.field_name,'`',' like %s']),value)
+        return self._prepare("`%s` like %%s"%self.field_name,value)
 
     def DL(self,format,value):
-        return self._prepare("".join(["DATE_FORMAT(`",self.field_name,"`,'",format,"')",'<=%s']),value)
+        return self._prepare("DATE_FORMAT(`%s`,'%s')<=%%s"%(self.field_name,format),value)
 
     def DG(self,format,value):
-        return self._prepare("".join(["DATE_FORMAT(`",self.field_name,"`,'",format,"')",'>=%s']),value) 
+        return self._prepare("DATE_FORMAT(`%s`,'%s')>=%%s"%(self.field_name,format),value)
 
     def DE(self,format,value):
-        return self._prepare("".join(["DATE_FORMAT(`",self.field_name,"`,'",format,"')",'=%s']),value)
+        return self._prepare("DATE_FORMAT(`%s`,'%s')=%%s"%(self.field_name,format),value)
 
     def __le__(self,value):
-        return self._prepare("".join(["`",self.field_name,'`','<=%s']),value)
+        return self._prepare("`%s`<=%%s"%self.field_name,value)
 
     def __lt__(self,value):
-        return self._prepare("".join(["`",self.field_name,'`','<%s']),value)
+        return self._prepare("`%s`<%%s"%self.field_name,value)
 
     def __gt__(self,value):
-        return self._prepare("".join(["`",self.field_name,'`','>%s']),value)
+        return self._prepare("`%s`>%%s"%self.field_name,value)
 
     def __ge__(self,value):
-        return self._prepare("".join(["`",self.field_name,'`','>=%s']),value)
+        return self._prepare("`%s`>=%%s"%self.field_name,value)
 
     def In(self,array):
         if not self._has_value:
-            if str(array.__class__)=="database.Select":
-                self._sql="".join(["`",self.field_name,'`',' in (',array.get_sql(),")"])
+            if isinstance(array,Select):
+                self._sql="`%s` in (%s)"%(self.field_name,array.get_sql())
                 for p in array.get_params():
                     self._params.append(p)
             else:
-                _values=",".join(["".join(['\'',i,'\'']) for i in array])
-                self._sql="".join(["`",self.field_name,'`',' in (',_values,")"])
-                self._has_value=True
+                _values=",".join(["'%s'"%i for i in array])
+                self._sql="`%s` in (%s)"%(self.field_name,_values)
+            self._has_value=True
             return self
         raise OperationalError,"Multiple Operate conditions"
     
     def Not_In(self,array):
         if not self._has_value:
-            if str(array.__class__)=="database.Select":
-                self._sql="".join(["`",self.field_name,'`',' not in (',array.get_sql(),")"])
+            if isinstance(array,Select):
+                self._sql="`%s` not in (%s)"%(self.field_name,array.get_sql())
                 for p in array.get_params():
                     self._params.append(p)
             else:
-                _values=",".join(["".join(['\'',i,'\'']) for i in array])
-                self._sql="".join(["`",self.field_name,'`',' not in (',_values,")"])
-                self._has_value=True
+                _values=",".join(["'%s'"%i for i in array])
+                self._sql="`%s` not in (%s)"%(self.field_name,_values)
+            self._has_value=True
             return self
         raise OperationalError,"Multiple Operate conditions"
 
     def __getattr__(self,func_name):
+        # Special method lookups (truth tests, iteration, copying) must
+        # not be mistaken for SQL functions
+        if func_name.startswith("__"):
+            raise AttributeError(func_name)
         if not self._has_value:
-            if str(array.__class__)=="database.Select":
-                self.self.field_name="".join([func_name,"(t.",self.field_name,") as ",func_name,"_",self.field_name])
-            else:
-                self.self.field_name="".join([func_name,"(",self.field_name,") as ",func_name,"_",self.field_name])
+            self.field_name="%s(%s) as %s_%s"%(func_name,self.field_name,func_name,self.field_name)
             return self
         raise OperationalError,"Multiple Operate conditions"
 
     def __and__(self,cond):
         if self._has_value:
+            if self._sub_conds is None:
+                self._sub_conds=[]
             self._sub_conds.append((cond," AND "))
             return self
         raise OperationalError,"Operation with no value"
 
     def __or__(self,cond):
         if self._has_value:
+            if self._sub_conds is None:
+                self._sub_conds=[]
             self._sub_conds.append((cond," OR "))
             return self
         raise OperationalError,"Operation with no value"
 
+# Picks the column name out of a PEP 249 cursor.description entry
+_column_name = operator.itemgetter(0)
+
+# Matches a backquoted column name, to qualify it with a table alias
+_BACKTICK_RE = re.compile(r'`(\w*?)`')
+
+# Splits an INSERT/REPLACE statement around its single VALUES (...) group
+_INSERT_VALUES_RE = re.compile(r'(\s*(?:insert|replace)\b.*?\bvalues?\s*)'
+                               r'(\((?:[^()]|\([^()]*\))*\))(.*)\Z',
+                               re.I | re.S)
+
+# Keep multi-row statements well under the server's max_allowed_packet
+_MAX_STATEMENT_LENGTH = 1024 * 1024
+
+# Tell reads from writes, and find the table a write statement touches
+_SELECT_RE = re.compile(r'\s*select\b', re.I)
+_WRITE_TABLE = r'(?:`?\w+`?\.)?`?(\w+)`?'
+_WRITE_RE = re.compile(
+    r'\s*(?:'
+    r'(?:insert(?:\s+(?:low_priority|delayed|high_priority))?(?:\s+ignore)?|'
+    r'replace(?:\s+(?:low_priority|delayed))?)(?:\s+into)?\s+' +
+    _WRITE_TABLE + r'(?=\s*\(|\s+(?:values?|set|select|partition)\b)|'
+    r'update(?:\s+low_priority)?(?:\s+ignore)?\s+' +
+    _WRITE_TABLE + r'(?=\s+set\b)|'
+    r'delete(?:\s+low_priority)?(?:\s+quick)?(?:\s+ignore)?\s+from\s+' +
+    _WRITE_TABLE + r'(?=\s*\Z|\s+(?:where|order|limit|partition)\b))',
+    re.I)
+
+# SELECTs whose result must never be cached: locking reads, and reads of
+# connection state, variables or functions that change between calls
+_UNCACHEABLE_RE = re.compile(
+    r'\bfor\s+(?:update|share)\b|\block\s+in\s+share\s+mode\b|@|'
+    r'\b(?:current_(?:date|time|timestamp|user)|localtime(?:stamp)?)\b|'
+    r'\b(?:last_insert_id|found_rows|row_count|connection_id|database|'
+    r'schema|user|session_user|system_user|now|sysdate|curdate|curtime|'
+    r'utc_date|utc_time|utc_timestamp|unix_timestamp|rand|uuid|uuid_short|'
+    r'get_lock|release_lock|is_free_lock|is_used_lock|sleep|benchmark)'
+    r'\s*\(', re.I)
+
 # Fix the access conversions to properly recognize unicode/binary
 FIELD_TYPE = MySQLdb.constants.FIELD_TYPE
 FLAG = MySQLdb.constants.FLAG
-CONVERSIONS = copy.deepcopy(MySQLdb.converters.conversions)
+# Only the lists patched below are copied; the rest are shared, unmodified
+CONVERSIONS = MySQLdb.converters.conversions.copy()
 for field_type in \
         [FIELD_TYPE.BLOB, FIELD_TYPE.STRING, FIELD_TYPE.VAR_STRING] + \
         ([FIELD_TYPE.VARCHAR] if 'VARCHAR' in vars(FIELD_TYPE) else []):
-    CONVERSIONS[field_type].insert(0, (FLAG.BINARY, str))
+    CONVERSIONS[field_type] = [(FLAG.BINARY, str)] + \
+        list(CONVERSIONS[field_type])
 
 
 # Alias some common MySQL exceptions